@@ -46,14 +46,24 @@ class Client(_Client):
     async def setup_hook(self):
         self.check_queue.start()
 
-    @tasks.loop(seconds=0.1)
+    @tasks.loop()
     async def check_queue(self):
-        while not queue.empty():
-            # this access is singlethreaded, so should never have a race
-            # condition with the empty check above.
-            (future, awaitable) = queue.get_nowait()
+        # sleep on the queue until something is fired, instead of polling it
+        # for emptiness.
+        (future, awaitable) = await queue.get()
+        # an exception escaping here would stop this loop for good, and with it
+        # every later fire_later. Hand it to whoever is waiting on the future
+        # instead.
+        try:
             r = await awaitable
-            future.set_result(r)
+        except Exception as e:
+            future.set_exception(e)
+            if self.error_log_channel:
+                err = "".join(traceback.format_exception(e))
+                await self.error_log_channel.send("Ignoring exception in "
+                    f"fired awaitable: \n```\n{err}\n```")
+            return
+        future.set_result(r)
 
     @check_queue.before_loop
     async def before_check_queue(self):
@@ -4,6 +4,10 @@ from sqlite3 import Row, Error as SqliteError
 from collections import defaultdict
 import inspect
 import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 
 from models import (SnitchChannel, Event, Snitch, LivemapChannel, Command,
     KiraConfig, LivemapLogChannel)
@@ -20,7 +24,7 @@ class Where:
         if not param:
             return
 
-        if isinstance(param, (list, set)):
+        if isinstance(param, (list, tuple, set, frozenset)):
             qs = "?, " * len(param)
             qs = f"({qs[:-2]})"
         else:
@@ -61,36 +65,8 @@ def create_db():
         )
         """
     )
-    c.execute("""
-        CREATE INDEX idx_event_channel
-        ON event (channel_id)
-    """)
-    c.execute("""
-        CREATE INDEX idx_event_guild
-        ON event (guild_id)
-    """)
-    c.execute("""
-        CREATE INDEX idx_event_username
-        ON event (username)
-    """)
-    c.execute("""
-        CREATE INDEX idx_event_snitch_name
-        ON event (snitch_name)
-    """)
-    c.execute("""
-        CREATE INDEX idx_event_snitch_namelayer_group
-        ON event (namelayer_group)
-    """)
-    # TODO we probably will want an index on `world` if/when we start consuming
-    # that column.
-    c.execute("""
-        CREATE INDEX idx_event_snitch_location
-        ON event (x, y, z)
-    """)
-    c.execute("""
-        CREATE INDEX idx_event_snitch_t
-        ON event (t)
-    """)
+    # event indexes are created below, along with the rest of the indexes added
+    # after the initial schema.
     c.execute(
         # schema matches gjum's snitchmod snitches_v2 table, with a few of our
         # own rows added
@@ -229,10 +205,31 @@ def create_db():
 
 if not db_path.exists():
     create_db()
-conn = sqlite3.connect(str(db_path))
+# seconds to wait for the other connection's write to finish before giving up
+# with "database is locked". Both our main connection and the writer's write to
+# the db, and some writes (like dropping a guild's events) can take a while.
+BUSY_TIMEOUT = 60
+# sqlite3 keeps a per-connection cache of compiled statements, keyed by the
+# query string. The default of 128 is a bit tight once every f-string variant
+# of our queries (different numbers of role / user placeholders) is counted.
+conn = sqlite3.connect(str(db_path), cached_statements=512,
+    timeout=BUSY_TIMEOUT)
 conn.row_factory = Row
 cur = conn.cursor()
 
+# WAL lets readers and our writes proceed without blocking each other, and
+# synchronous=NORMAL only fsyncs at wal checkpoints instead of on every commit.
+# This is safe against the bot crashing, with a small risk of losing the most
+# recent commits (but not corrupting the db) on an os crash or power loss. We
+# can always reindex anything lost that way.
+cur.execute("PRAGMA journal_mode = WAL")
+cur.execute("PRAGMA synchronous = NORMAL")
+cur.execute("PRAGMA temp_store = MEMORY")
+# negative cache_size is in kib, so this is 128mb.
+cur.execute("PRAGMA cache_size = -131072")
+# 256mb
+cur.execute("PRAGMA mmap_size = 268435456")
+
 # if the sqlite file exists, but has no tables, initialize it anyway.
 # Added to support docker volumes which require the file to exist beforehand.
 tables = (cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
@@ -240,6 +237,144 @@ tables = (cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
 if not tables:
     create_db()
 
+# indexes added after the initial schema. These are created here instead of in
+# create_db so that existing databases pick them up as well.
+#
+# Every event query filters on guild_id, so the event indexes all lead with it.
+# Each index below notes which queries use it. Every index costs us on each
+# insert while indexing, so don't add one unless a query's plan uses it.
+#
+# get_snitch_events, which streams the GROUP BY off this index instead of
+# sorting every event in the guild.
+cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_event_guild_location
+    ON event (guild_id, world, x, y, z)
+""")
+# .events lookups by name and by location, most recent first
+cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_event_guild_snitch_name_t
+    ON event (guild_id, snitch_name, t)
+""")
+# including t lets sqlite read the most recent events at a location straight
+# off the index, instead of sorting every event there. This replaces an older
+# (guild_id, x, y, z) index, which it covers.
+cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_event_guild_x_y_z_t
+    ON event (guild_id, x, y, z, t)
+""")
+cur.execute("DROP INDEX IF EXISTS idx_event_guild_x_y_z")
+# get_events (with or without a time range), most_recent_event, and dropping a
+# guild's events in full-reindex
+cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_event_guild_t
+    ON event (guild_id, t)
+""")
+# indexes from the initial schema which no query uses. Either the guild indexes
+# above cover them, or (for username and namelayer_group) we only ever compare
+# LOWER() of the column, which can't use a plain index.
+for index in ["idx_event_channel", "idx_event_guild", "idx_event_username",
+    "idx_event_snitch_name", "idx_event_snitch_namelayer_group",
+    "idx_event_snitch_location", "idx_event_snitch_t"]:
+    cur.execute(f"DROP INDEX IF EXISTS {index}")
+# allowed roles for a snitch channel, looked up whenever we load one
+cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_snitch_channel_allowed_roles_channel
+    ON snitch_channel_allowed_roles (channel_id)
+""")
+# livemap channel lookups by channel instead of guild
+cur.execute("""
+    CREATE INDEX IF NOT EXISTS idx_livemap_channel_channel
+    ON livemap_channel (channel_id)
+""")
+conn.commit()
+
+# keep the query planner's statistics up to date, so it actually picks the
+# indexes above (in particular the (guild_id, t) index for time ranges). 0x10000
+# asks sqlite to check every table, not just ones this connection has queried,
+# which is none yet. analysis_limit keeps this from scanning entire tables on
+# large databases.
+cur.execute("PRAGMA analysis_limit = 400")
+cur.execute("PRAGMA optimize = 0x10002")
+
+# Bulk writes (mostly events while indexing) happen on their own connection in
+# a dedicated thread, so that inserting and committing thousands of rows doesn't
+# block the event loop. There's only ever one writer thread, so writes are
+# applied in the order they're submitted. Thanks to WAL, reads on our main
+# connection don't block on these writes, and see them as soon as they're
+# committed.
+writer_conn = None
+
+def _init_writer():
+    # sqlite connections can only be used from the thread that created them
+    global writer_conn
+    writer_conn = sqlite3.connect(str(db_path), timeout=BUSY_TIMEOUT)
+    # synchronous is per-connection, unlike journal_mode
+    writer_conn.execute("PRAGMA synchronous = NORMAL")
+
+writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer",
+    initializer=_init_writer)
+
+def _write(statements):
+    t1 = time.time()
+    rowcounts = []
+    # commits on success and rolls back on error
+    with writer_conn:
+        for (query, params) in statements:
+            try:
+                cursor = writer_conn.executemany(query, params)
+            except SqliteError:
+                print(f"error on query {query} ({len(params)} rows)",
+                    flush=True)
+                raise
+            rowcounts.append(cursor.rowcount)
+
+    for (query, params) in statements:
+        print(f"[db writer] {time.time() - t1} {query} ({len(params)} rows)")
+    return rowcounts
+
+async def write(statements):
+    # `statements` is a list of (query, list of params) tuples. Each is run with
+    # executemany, and all of them are committed together in a single
+    # transaction. Returns the number of rows each statement modified.
+    #
+    # Use this for any write which might take a while, so it doesn't block the
+    # event loop (or our main connection).
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(writer, _write, statements)
+
+# Reads which can take a while - mostly scanning a guild's events for a render
+# - happen on a small pool of reader threads, each with its own connection, so
+# they don't block the event loop. Only use these for plain selects: everything
+# else goes through our main connection or the writer.
+reader_local = threading.local()
+
+def _init_reader():
+    reader_conn = sqlite3.connect(str(db_path), cached_statements=512)
+    reader_conn.row_factory = Row
+    reader_conn.execute("PRAGMA temp_store = MEMORY")
+    reader_conn.execute("PRAGMA mmap_size = 268435456")
+    reader_local.conn = reader_conn
+
+readers = ThreadPoolExecutor(max_workers=4, thread_name_prefix="db-reader",
+    initializer=_init_reader)
+
+def reader_select(query, params=[]):
+    # select, but on a reader thread's connection. Only call this from
+    # functions run with `read`.
+    t1 = time.time()
+    try:
+        rows = reader_local.conn.execute(query, params).fetchall()
+    except SqliteError:
+        print(f"error on query {query} params {params}", flush=True)
+        raise
+    print(f"[db reader] {time.time() - t1} {query} {params}")
+    return rows
+
+async def read(f, *args):
+    # runs f(*args) on a reader thread
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(readers, f, *args)
+
 def commit():
     conn.commit()
 
@@ -275,15 +410,22 @@ def convert(rows, Class):
     instances = []
     # Extraneous parameters not relevant to `Class` can sneak in via sql
     # joins. Filter this out to avoid errors on instantation.
-    parameters = list(inspect.signature(Class.__init__).parameters)
+    parameters = set(inspect.signature(Class.__init__).parameters)
 
+    # every row from a single query has the same columns, so work out which
+    # columns we care about once instead of once per row.
+    columns = None
     for row in rows:
         if isinstance(row, Row):
-            values = list(row)
+            values = tuple(row)
         else:
-            values = row.values()
+            values = tuple(row.values())
+
+        if columns is None:
+            columns = [(i, k) for i, k in enumerate(row.keys())
+                if k in parameters]
 
-        kwargs = {k: v for k, v in zip(row.keys(), values) if k in parameters}
+        kwargs = {k: values[i] for i, k in columns}
         instances.append(Class(**kwargs))
     print(f"[convert] {time.time() - t}")
     return instances
@@ -314,25 +456,41 @@ def get_snitches(guild_id, roles):
 
     return convert(rows, Snitch)
 
-def add_snitch(guild_id, snitch, allowed_roles, commit=True):
-    args = [
-        guild_id, snitch.world, snitch.x, snitch.y, snitch.z, snitch.group_name,
-        snitch.type, snitch.name, snitch.dormant_ts, snitch.cull_ts,
-        snitch.first_seen_ts, snitch.last_seen_ts, snitch.created_ts,
-        snitch.created_by_uuid, snitch.renamed_ts, snitch.renamed_by_uuid,
-        snitch.lost_jalist_access_ts, snitch.broken_ts, snitch.gone_ts,
-        snitch.tags, snitch.notes
+async def add_snitches(guild_id, snitches, allowed_roles):
+    params = [
+        [
+            guild_id, snitch.world, snitch.x, snitch.y, snitch.z,
+            snitch.group_name, snitch.type, snitch.name, snitch.dormant_ts,
+            snitch.cull_ts, snitch.first_seen_ts, snitch.last_seen_ts,
+            snitch.created_ts, snitch.created_by_uuid, snitch.renamed_ts,
+            snitch.renamed_by_uuid, snitch.lost_jalist_access_ts,
+            snitch.broken_ts, snitch.gone_ts, snitch.tags, snitch.notes
+        ]
+        for snitch in snitches
     ]
-    # ignore duplicate snitches
-    cur = execute("INSERT OR IGNORE INTO snitch VALUES (?, ?, ?, ?, ?, ?, "
-        "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", args, commit)
-    rowcount = cur.rowcount
-
+    if not params:
+        return 0
+
+    # ignore duplicate snitches. rowcount is the total number of rows inserted
+    # across all params for executemany.
+    statements = [("INSERT OR IGNORE INTO snitch VALUES (?, ?, ?, ?, ?, ?, ?, "
+        "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", params)]
+
+    # look the snitch rowids back up by location, since executemany doesn't
+    # give us the inserted rowids.
+    locations = [[snitch.world, snitch.x, snitch.y, snitch.z, guild_id]
+        for snitch in snitches]
     for role in allowed_roles:
-        execute("INSERT OR IGNORE INTO snitch_allowed_roles VALUES (?, ?)",
-        [cur.lastrowid, role.id], commit)
+        statements.append(("""
+            INSERT OR IGNORE INTO snitch_allowed_roles
+            SELECT rowid, ? FROM snitch
+            WHERE world = ? AND x = ? AND y = ? AND z = ? AND guild_id = ?
+            """, [[role.id, *location] for location in locations]))
 
-    return rowcount
+    # import all or nothing (a single transaction), so a failed import can be
+    # safely re-run
+    rowcounts = await write(statements)
+    return rowcounts[0]
 
 ## snitch channels
 
@@ -373,9 +531,12 @@ def add_snitch_channel(channel, roles):
     # batch commit in case we're adding a ton of roles/channels, probably not
     # necessary
     commit()
+    accessible_channels.cache_clear()
 
 def remove_snitch_channel(channel_id):
-    return execute("DELETE FROM snitch_channel WHERE id = ?", [channel_id])
+    ret = execute("DELETE FROM snitch_channel WHERE id = ?", [channel_id])
+    accessible_channels.cache_clear()
+    return ret
 
 def snitch_channel_exists(channel_id):
     rows = select("SELECT * FROM snitch_channel WHERE id = ?",
@@ -406,7 +567,12 @@ def update_last_indexed(channel_id, message_id, commit=True):
 
 ## events
 
-def add_event(message, event, commit=True):
+async def add_events_bulk(pairs, *, last_indexed={}):
+    # `pairs` is a list of (message, event) tuples. Inserts all rows with a
+    # single prepared statement, in the writer thread. `last_indexed` is an
+    # optional dict of channel id to message id, to update the last indexed ids
+    # of channels in the same transaction.
+    #
     # use the message's timestmap instead of trying to parse the event.
     # Some servers might have crazy snitch log formats, and the default format
     # doesn't even include the day/month/year, so we would be partially relying
@@ -414,11 +580,25 @@ def add_event(message, event, commit=True):
     # Still, this might result in events which are a few seconds off from when
     # they actually occurred, or potentially more if kira got desynced or
     # backlogged.
-    t = message.created_at.timestamp()
-    return execute("INSERT OR IGNORE INTO event VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+    params = [
         [message.id, message.channel.id, message.guild.id, event.username,
          event.snitch_name, event.namelayer_group, event.world, event.x,
-         event.y, event.z, t], commit)
+         event.y, event.z, message.created_at.timestamp()]
+        for (message, event) in pairs
+    ]
+    last_indexed_params = [[message_id, channel_id]
+        for (channel_id, message_id) in last_indexed.items()]
+
+    statements = []
+    if params:
+        statements.append(("INSERT OR IGNORE INTO event VALUES (?, ?, ?, ?, ?, "
+            "?, ?, ?, ?, ?, ?)", params))
+    if last_indexed_params:
+        statements.append(("UPDATE snitch_channel SET last_indexed_id = ? "
+            "WHERE id = ?", last_indexed_params))
+    if not statements:
+        return
+    await write(statements)
 
 def event_exists(message_id):
     rows = select("SELECT * FROM event WHERE message_id = ?", [message_id])
@@ -445,10 +625,67 @@ def most_recent_event(guild_id, *, users=[], groups=[]):
     event.convert_t()
     return event
 
-def get_events(
-    guild_id, roles, *, start=None, end=None, users=[], groups=[],
-    convert_t=True
+# These are kept as constants, rather than built per call, so the statement
+# cache always gets a hit for them.
+RECENT_EVENTS_BY_NAME = """
+    SELECT * FROM event
+    WHERE guild_id = ? AND snitch_name = ?
+    ORDER BY t DESC LIMIT ?
+"""
+RECENT_EVENTS_BY_XYZ = """
+    SELECT * FROM event
+    WHERE guild_id = ? AND x = ? AND y = ? AND z = ?
+    ORDER BY t DESC LIMIT ?
+"""
+# the unary + stops sqlite from walking the (guild_id, t) index to satisfy the
+# ORDER BY, which would scan the guild's entire history for a location with few
+# events. Sorting the events at a single x/z location is cheap.
+RECENT_EVENTS_BY_XY = """
+    SELECT * FROM event
+    WHERE guild_id = ? AND x = ? AND y = ?
+    ORDER BY +t DESC LIMIT ?
+"""
+
+def recent_events_by_name(guild_id, snitch_name, *, limit=10):
+    return select(RECENT_EVENTS_BY_NAME, [guild_id, snitch_name, limit])
+
+def recent_events_at(guild_id, x, y, z=None, *, limit=10):
+    # x, y, and z are as stored in the db, which has y and z swapped compared
+    # to minecraft coordinates.
+    if z is None:
+        return select(RECENT_EVENTS_BY_XY, [guild_id, x, y, limit])
+    return select(RECENT_EVENTS_BY_XYZ, [guild_id, x, y, z, limit])
+
+@lru_cache(maxsize=1024)
+def accessible_channels(guild_id, role_ids):
+    # returns the ids of the snitch channels which any of `role_ids` (a
+    # frozenset) has access to. Cached since this only changes when snitch
+    # channels are added or removed, which clears the cache.
+    snitch_channels = get_snitch_channels(guild_id)
+    channel_ids = set()
+
+    # TODO can we do this filtering based on allowed roles entirely in sql?
+    # Probably not worth it until/if it becomes a performance concern.
+
+    # build a dict to avoid potentially cubic behavior. This is still
+    # quadratic, but hopefully no more than a few hundred iterations at
+    #  worst.
+    role_to_channels = defaultdict(set)
+    for channel in snitch_channels:
+        for role in channel.allowed_roles:
+            role_to_channels[role].add(channel.id)
+
+    # for each role, add any snitch channels that role gives them permission
+    # to view.
+    for role_id in role_ids:
+        channel_ids |= role_to_channels[role_id]
+
+    return frozenset(channel_ids)
+
+def events_where(guild_id, roles, *, start=None, end=None, users=[],
+    groups=[]
 ):
+    # returns None if `roles` doesn't have permission to view any events
     users = [user.lower() for user in users]
 
     where = Where()
@@ -463,43 +700,59 @@ def get_events(
     where.add("LOWER(username) IN ", users)
     where.add("LOWER(namelayer_group) IN ", groups)
 
-    snitch_channels = get_snitch_channels(guild_id)
-    channel_ids = set()
-
     # special value of `all` to retrieve all events, regardless of permissions
-    if roles != "all":
-        # TODO can we do this filtering based on allowed roles entirely in sql?
-        # Probably not worth it until/if it becomes a performance concern.
-
-        # build a dict to avoid potentially cubic behavior. This is still
-        # quadratic, but hopefully no more than a few hundred iterations at
-        #  worst.
-        role_to_channels = defaultdict(set)
-        for channel in snitch_channels:
-            for role in channel.allowed_roles:
-                role_to_channels[role].add(channel.id)
-
-        # for each role, add any snitch channels that role gives them permission
-        # to view.
-        for role in roles:
-            channels = role_to_channels[role.id]
-            channel_ids |= channels
-
-        if not channel_ids:
-            # if the author doesn't have permission to view any channels, don't
-            # return any events
-            return []
-
-        where.add("channel_id IN ", channel_ids)
+    if roles == "all":
+        return where
 
-    rows = select(
-        f"""
+    channel_ids = accessible_channels(guild_id,
+        frozenset(role.id for role in roles))
+
+    if not channel_ids:
+        # if the author doesn't have permission to view any channels, don't
+        # return any events
+        return None
+
+    where.add("channel_id IN ", channel_ids)
+    return where
+
+# number of rows to fetch and convert at a time in get_events
+EVENTS_FETCH_SIZE = 10_000
+
+async def get_events(
+    guild_id, roles, *, start=None, end=None, users=[], groups=[],
+    convert_t=True
+):
+    # permissions are checked here, since they're cached and need our main
+    # connection on a miss. The (possibly very large) event scan happens on a
+    # reader thread.
+    where = events_where(guild_id, roles, start=start, end=end, users=users,
+        groups=groups)
+    if where is None:
+        return []
+
+    return await read(_get_events, where, convert_t)
+
+def _get_events(where, convert_t):
+    t1 = time.time()
+    query = f"""
         SELECT * FROM event
         {where.query}
-        """,
-        [*where.params]
-    )
-    events = convert(rows, Event)
+    """
+    try:
+        cursor = reader_local.conn.execute(query, where.params)
+    except SqliteError:
+        print(f"error on query {query} params {where.params}", flush=True)
+        raise
+
+    # convert rows in batches instead of fetching every row up front. Otherwise
+    # we'd hold every sqlite row and every Event in memory at the same time,
+    # which for `--past all` renders on large guilds roughly doubles our peak
+    # memory.
+    events = []
+    while rows := cursor.fetchmany(EVENTS_FETCH_SIZE):
+        events += convert(rows, Event)
+    print(f"[db reader] {time.time() - t1} {query} {where.params} "
+        f"({len(events)} rows)")
 
     # as an optimization, only convert t into a datetime when necessary.
     # Frankly, I'm not sure how much this helps, but may make a difference when
@@ -509,6 +762,35 @@ def get_events(
             event.convert_t()
     return events
 
+async def get_snitch_events(guild_id, roles):
+    # one event per snitch location (the most recent one), for constructing
+    # snitches with snitches_from_events. Much cheaper than retrieving every
+    # event when all we care about is which snitches have been pinged. Still a
+    # scan over all of a guild's events though, so like get_events it happens
+    # on a reader thread.
+    where = events_where(guild_id, roles)
+    if where is None:
+        return []
+
+    return await read(_get_snitch_events, where)
+
+def _get_snitch_events(where):
+    # sqlite uses the row with the max value for any bare columns when
+    # aggregating with MAX, so this returns the most recent event at each
+    # location. Without good statistics sqlite prefers the (guild_id, t) index
+    # for the t filter here, and then has to sort every event in the guild for
+    # the GROUP BY. The t filter barely filters anything for this query, so
+    # walk the location index instead.
+    rows = reader_select(
+        f"""
+        SELECT *, MAX(t) FROM event INDEXED BY idx_event_guild_location
+        {where.query}
+        GROUP BY world, x, y, z
+        """,
+        [*where.params]
+    )
+    return convert(rows, Event)
+
 ## render history
 
 def get_pixel_usage(guild_id, start, end):
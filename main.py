@@ -1,19 +1,26 @@
 from datetime import datetime, timedelta
-from tempfile import NamedTemporaryFile, TemporaryDirectory
+from tempfile import TemporaryDirectory
 import sqlite3
 from pathlib import Path
-from asyncio import Queue
+from io import BytesIO
+from asyncio import Queue, QueueEmpty, QueueFull
 from concurrent.futures import ProcessPoolExecutor
 from functools import partial
+from heapq import heappush, heappop
+from copy import copy
 import gzip
 from collections import defaultdict
 import re
+import string
 import traceback
 import random
 import asyncio
+import time
+import multiprocessing
+import os
 
-from discord import File
-from discord.utils import utcnow
+from discord import File, Message
+from discord.utils import utcnow, time_snowflake
 from discord.ext.tasks import loop
 from snitchvis import (Event, InvalidEventException, SnitchVisRecord,
     create_users, snitches_from_events, Snitch, Config, SnitchVisImage)
@@ -21,7 +28,7 @@ from PyQt6.QtWidgets import QApplication
 
 import db
 import utils
-from utils import fire_later
+from utils import fire_later, delete_message
 import config
 from models import KiraConfig, FakeMessage
 from command import (command, Arg, channel, role, human_timedelta,
@@ -31,6 +38,30 @@ from client import Client
 INVITE_LINK = ("https://discord.com/oauth2/authorize?client_id="
     "999808708131426434&permissions=0&scope=bot")
 
+DEFAULT_KIRA_CONFIG = KiraConfig(None, "`[%TIME%]` `[%GROUP%]` "
+    "**%PLAYER%** %ACTION% at %SNITCH% (%X%,%Y%,%Z%) %PING%",
+    "is", "logged in", "logged out", "HH:mm:ss")
+
+# patterns for parsing the output of `!kira relayconfig <config_name>`
+KIRA_CONFIG_NAME = re.compile(r"Relay config \*\*(.*)\*\* is owned by")
+KIRA_CONFIG_SNITCH = re.compile(r"Format used for snitch alerts "
+    r"\(snitchformat\): `` (.*) ``")
+KIRA_CONFIG_ENTER = re.compile(r"Format used for entering a snitch range "
+    r"\(snitchentermessage\): `` (.*) ``")
+KIRA_CONFIG_LOGIN = re.compile(r"logins within a snitch range "
+    r"\(snitchloginmessage\): `` (.*) ``")
+# yes, kira has a typo (should be snitchlogoutmessage)
+KIRA_CONFIG_LOGOUT = re.compile(r"Format used for logouts within a snitch "
+    r"range \(snitchloginmessage\): `` (.*) ``")
+KIRA_CONFIG_TIME = re.compile(r"Time format used for the time stamps of "
+    r"messages \(timeformat\): `` (.*) ``")
+
+# sqlite's NOCASE collation only folds ascii letters, unlike str.lower
+NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+def nocase(val):
+    return val.translate(NOCASE)
+
 def run_snitch_vis(*args):
     vis = SnitchVisRecord(*args)
     vis.render()
@@ -47,6 +78,46 @@ class Snitchvis(Client):
     PIXEL_LIMIT_DAY   =  500_000_000_000
     # number of maximum concurrent renders allowed per guild
     MAXIMUM_CONCURRENT_RENDERS = 2
+    # number of snitch channels to index at the same time in `.index`
+    MAXIMUM_CONCURRENT_INDEXES = 4
+    # number of events to write to the db at once when indexing a channel
+    INDEX_BATCH_SIZE = 500
+    # minimum number of seconds between edits of the `.index` progress message
+    INDEX_PROGRESS_INTERVAL = 2
+    # maximum number of messages waiting to be indexed, see indexing_queue
+    INDEXING_QUEUE_SIZE = 10_000
+    # number of processes to render videos in
+    RENDER_WORKERS = max(1, os.cpu_count() // 2)
+    # number of video renders to send to a render pool before replacing it with
+    # a fresh one, see render_pool
+    RENDER_POOL_MAX_RENDERS = 10
+    # maximum number of (guild, roles) snitch sets to cache, see self.snitches
+    SNITCH_CACHE_SIZE = 64
+    # number of processes to render livemap images in
+    LIVEMAP_WORKERS = 2
+    # order of commands (by method name) in `.help`. Commands not listed here
+    # go at the end.
+    HELP_ORDER = [
+        "render",
+        "channel_add",
+        "channel_remove",
+        "channel_list",
+        "set_livemap_channel",
+        "create_command",
+        "list_commands",
+        "import_snitches",
+        "add_kira_config",
+        "events",
+        "permissions",
+        "index",
+        "full_reindex",
+        "tutorial",
+        "invite",
+        "help",
+        "set_prefix",
+    ]
+    # method name to position in HELP_ORDER, for sorting
+    HELP_ORDER_INDEX = {name: i for i, name in enumerate(HELP_ORDER)}
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -56,56 +127,137 @@ class Snitchvis(Client):
         # gets processed and causes the last indexed id to be set to a very high
         # id, causing us not to index the messages we didn't see while we were
         # down when self.index_channel gets called on c.
-        # To prevent this, we'll stop indexing new messages at all while
-        # indexing channels on startup, and instead stick the new messages into
-        # a queue. This queue will be processed in the order the messages were
-        # received once we're done indexing the channels and can be assured we
-        # won't mess up our last_indexed_id.
-        self.defer_indexing = False
-        self.indexing_queue = Queue()
-        # channel id to datetime
+        # To prevent this, new messages always go into a queue, which
+        # index_queued_messages processes in the order the messages were
+        # received. While indexing channels on startup, can_index is cleared and
+        # index_queued_messages waits until we're done indexing the channels
+        # and can be assured we won't mess up our last_indexed_id.
+        self.can_index = asyncio.Event()
+        self.indexing_queue = Queue(maxsize=self.INDEXING_QUEUE_SIZE)
+        # ids of channels which had messages dropped from indexing_queue
+        # because it was full
+        self.overflowed_channels = set()
+        # channel id to the messages received in that channel while it's being
+        # re-indexed after overflowing, see reindex_overflowed_channel
+        self.reindexing_channels = {}
+        # channel id to the task re-indexing that channel. Held so the tasks
+        # don't get garbage collected while they run.
+        self.reindex_tasks = {}
+        # channel id to time.monotonic() of the last upload
         self.livemap_last_uploaded = {}
-        # channel id to list of datetimes
-        self.livemaps_refresh_at = {}
+        # min-heap of (refresh at, channel id, generation), where refresh at is
+        # in time.monotonic() seconds. Scheduling
+        # new refreshes for a channel replaces its old ones by bumping its
+        # generation in livemap_refresh_generation; stale entries are skipped
+        # when they're popped.
+        self.livemap_refresh_heap = []
+        # channel id to generation
+        self.livemap_refresh_generation = {}
         # currently updating livemap ids, so we don't double-update on quick
         # successive snitch hits
-        self.livemap_updating_channels = []
+        self.livemap_updating_channels = set()
+        # livemap channel id to (LivemapChannel, refresh) for a livemap which
+        # needs to be redrawn, where refresh is as in update_livemap_channel.
+        # Consumed by that channel's task in livemap_tasks.
+        self.livemap_pending = {}
+        # livemap channel id to the task currently updating that livemap. New
+        # events which arrive while a livemap is updating are coalesced into a
+        # single follow up update by the same task.
+        self.livemap_tasks = {}
+        # channel id to SnitchChannel, or None if the channel isn't a snitch
+        # channel. Cached to avoid a db hit on every message we receive. Must be
+        # invalidated whenever a snitch channel is added/removed or its
+        # last_indexed_id changes.
+        self.snitch_channels = {}
+        # (guild id, role ids) to the set of snitches those roles can see in
+        # that guild. Recomputing this requires a scan over all of a guild's
+        # events, so cache it. Invalidated whenever a guild gets new snitches or
+        # snitch channels, or has a channel indexed. Events from new messages
+        # are added incrementally instead, see update_snitches. Each distinct
+        # set of roles gets its own copy of the guild's snitches, so only the
+        # SNITCH_CACHE_SIZE most recently used entries are kept.
+        self.snitches = {}
+        # guild id to a counter which is bumped whenever that guild's cached
+        # snitches change. Lets get_snitches tell whether its result went
+        # stale while it was waiting on the db.
+        self.snitches_generation = defaultdict(int)
+        # guild id to that guild's kira configs, including the default config
+        # (first). Cached so we don't hit the db for every message we try to
+        # parse, and so each config's precomputed prefix and formats are
+        # reused. Invalidated when a config is added or updated.
+        self.kira_configs = {}
+        # guild id to a tuple of the prefixes of that guild's kira configs, for
+        # rejecting messages which can't match any config in one check. Cached
+        # and invalidated alongside kira_configs.
+        self.kira_prefixes = {}
+        # guild id to that guild's livemap channel, or None if it doesn't have
+        # one. Most guilds don't, and we'd otherwise hit the db for every batch
+        # of indexed events. Invalidated when a guild sets its livemap channel.
+        self.livemap_channels = {}
         # guilds which we're currently indexing, so we don't double-index
-        self.indexing_guilds = []
+        self.indexing_guilds = set()
         # guild id to number of currently running renders. used to limit number
         # of concurrent renders to prevent abuse
         self.concurrent_renders = defaultdict(int)
-        self.help_order = [
-            self.render,
-            self.channel_add,
-            self.channel_remove,
-            self.channel_list,
-            self.set_livemap_channel,
-            self.create_command,
-            self.list_commands,
-            self.import_snitches,
-            self.add_kira_config,
-            self.events,
-            self.permissions,
-            self.index,
-            self.full_reindex,
-            self.tutorial,
-            self.invite,
-            self.help,
-            self.set_prefix,
-        ]
+        # limits renders in flight across all guilds to the number of render
+        # processes. Renders past this wait on the semaphore instead of piling
+        # up inside render_pool, which lets us tell people when their render is
+        # waiting on others.
+        self.render_semaphore = asyncio.Semaphore(self.RENDER_WORKERS)
+        # pool for video renders, so we don't pay for spinning up a new pool on
+        # every render. See the comment in `render` for why renders happen in a
+        # separate process at all: render workers leak memory, so the pool is
+        # replaced every RENDER_POOL_MAX_RENDERS renders, and the old workers
+        # exit (giving their memory back to the OS) once their renders finish.
+        # See get_render_pool.
+        self.render_pool = self.create_render_pool()
+        # number of renders sent to render_pool so far
+        self.render_pool_renders = 0
+        # livemaps get their own pool, so they're never stuck waiting behind
+        # long video renders. Livemap images are small and render every few
+        # seconds.
+        self.livemap_pool = ProcessPoolExecutor(
+            max_workers=self.LIVEMAP_WORKERS,
+            mp_context=multiprocessing.get_context("fork")
+        )
+
+    def create_render_pool(self):
+        # Fork so workers inherit our qapp. max_tasks_per_child can't be
+        # combined with fork, and spawned workers would re-import this module
+        # (and with it the db) just to get a qapp, hence recycling whole pools
+        # instead. Workers only ever render, and never touch the db, so forking
+        # while the db threads are running is safe.
+        return ProcessPoolExecutor(
+            max_workers=self.RENDER_WORKERS,
+            mp_context=multiprocessing.get_context("fork")
+        )
 
-        self.default_kira_config = KiraConfig(None, "`[%TIME%]` `[%GROUP%]` "
-            "**%PLAYER%** %ACTION% at %SNITCH% (%X%,%Y%,%Z%) %PING%",
-            "is", "logged in", "logged out", "HH:mm:ss")
+    def get_render_pool(self):
+        # the pool to send the next render to
+        if self.render_pool_renders >= self.RENDER_POOL_MAX_RENDERS:
+            # renders already running in the old pool still finish, after
+            # which its workers exit.
+            self.render_pool.shutdown(wait=False)
+            self.render_pool = self.create_render_pool()
+            self.render_pool_renders = 0
+        self.render_pool_renders += 1
+        return self.render_pool
+
+    async def close(self):
+        await super().close()
+        # don't leave render processes behind when we shut down. Any renders
+        # still running are abandoned.
+        self.render_pool.shutdown(wait=False, cancel_futures=True)
+        self.livemap_pool.shutdown(wait=False, cancel_futures=True)
 
     async def on_ready(self):
         await super().on_ready()
         print("connected to discord")
         # avoid last_indexed_id getting set to a wrong value by incoming
         # messages while we index channels
-        self.defer_indexing = True
+        self.can_index.clear()
         # index any messages sent while we were down
+        to_index = []
         for channel in db.get_snitch_channels(None):
             c = self.get_channel(channel.id)
             if c is None:
@@ -116,21 +268,161 @@ class Snitchvis(Client):
                 print(f"Couldn't index {c} / {c.id} (guild {c.guild} / "
                     f"{c.guild.id}) without read_messages permission")
                 continue
-            await self.index_channel(channel, c)
+            to_index.append((channel, c))
+
+        # like `.index`, index several channels at once since we're mostly
+        # waiting on discord.
+        sem = asyncio.Semaphore(self.MAXIMUM_CONCURRENT_INDEXES)
+
+        async def _index(channel, c):
+            async with sem:
+                await self.index_channel(channel, c)
+
+        results = await asyncio.gather(*(_index(channel, c)
+            for (channel, c) in to_index), return_exceptions=True)
         db.commit()
 
-        # index messages in the order we received them now that it's safe to do
-        # so. New messages might get added to the queue while we're in the
-        # middle of processing these, so it's important to continuously poll the
-        # queue.
-        while not self.indexing_queue.empty():
-            message = await self.indexing_queue.get()
-            snitch_channel = db.get_snitch_channel(message.channel.id)
+        # don't let one bad channel stop us from indexing the rest
+        for ((channel, c), result) in zip(to_index, results):
+            if not isinstance(result, Exception):
+                continue
+            err = "".join(traceback.format_exception(result))
+            await self.error_log_channel.send(f"Ignoring exception while "
+                f"indexing {c} / {c.id} (guild {c.guild} / {c.guild.id}) on "
+                f"startup: \n```\n{err}\n```")
+
+        # now that we've indexed the channels, it's safe to index the messages
+        # we received in the meantime, and any new messages.
+        self.can_index.set()
+
+        # on_ready can be called multiple times by discordpy, not just when
+        # the bot starts. Avoid an error by starting an already-started task.
+        if not self.index_queued_messages.is_running(): # pylint: disable=no-member
+            self.index_queued_messages.start() # pylint: disable=no-member
+        if not self.check_outdated_livemaps.is_running(): # pylint: disable=no-member
+            self.check_outdated_livemaps.start() # pylint: disable=no-member
+
+    async def on_message(self, message):
+        await super().on_message(message)
+
+        # only hold on to messages we might actually index
+        if not self.get_snitch_channel(message.channel.id):
+            return
+        try:
+            self.indexing_queue.put_nowait(message)
+        except QueueFull:
+            # don't hold an unbounded number of messages in memory. Remember
+            # which channel we dropped messages from and re-index it once
+            # we've caught up with the queue instead.
+            self.overflowed_channels.add(message.channel.id)
+
+    @loop()
+    async def index_queued_messages(self):
+        try:
+            messages = [await self.indexing_queue.get()]
+            await self.can_index.wait()
+            # index everything else currently in the queue as a single batch as
+            # well, instead of paying for a transaction per message.
+            while True:
+                try:
+                    messages.append(self.indexing_queue.get_nowait())
+                except QueueEmpty:
+                    break
+
+            # skip messages in channels where we dropped messages because the
+            # queue was full. We'll re-index those channels from their last
+            # indexed id below instead, which picks these messages up as well.
+            # Indexing these now would move the last indexed id past the
+            # dropped messages. Messages in channels which are currently being
+            # re-indexed are held until the re-index finishes instead.
+            to_index = []
+            for m in messages:
+                deferred = self.reindexing_channels.get(m.channel.id)
+                if deferred is not None:
+                    deferred.append(m)
+                elif m.channel.id not in self.overflowed_channels:
+                    to_index.append(m)
+            try:
+                await self.index_messages(to_index)
+            except Exception:
+                # a batch's events and last indexed ids are committed together,
+                # so if writing it failed, its channels are still at their old
+                # last indexed ids. Re-index them from there (see below)
+                # instead of dropping the batch.
+                self.overflowed_channels.update(m.channel.id for m in to_index)
+                raise
+
+            if self.indexing_queue.empty() and self.overflowed_channels:
+                # channels which overflowed again while being re-indexed wait
+                # for that re-index to finish first.
+                channel_ids = (self.overflowed_channels -
+                    self.reindexing_channels.keys())
+                self.overflowed_channels -= channel_ids
+                for channel_id in channel_ids:
+                    snitch_channel = self.get_snitch_channel(channel_id)
+                    c = self.get_channel(channel_id)
+                    # like index_messages, leave channels which were never
+                    # fully indexed to `.index`.
+                    if (not snitch_channel or not snitch_channel.last_indexed_id
+                        or c is None):
+                        continue
+                    # re-indexing walks the channel's history, so don't hold up
+                    # indexing new messages in every other channel meanwhile.
+                    self.reindexing_channels[channel_id] = []
+                    task = asyncio.create_task(
+                        self.reindex_overflowed_channel(snitch_channel, c))
+                    self.reindex_tasks[channel_id] = task
+        except Exception as e:
+            err = "".join(traceback.format_exception(e))
+            await self.error_log_channel.send(f"Ignoring exception in event "
+                f"loop `index_queued_messages`: \n```\n{err}\n```")
+
+    async def reindex_overflowed_channel(self, channel, discord_channel):
+        channel_id = channel.id
+        try:
+            await self.index_channel(channel, discord_channel)
+            # index whatever came in while we were walking the history. Most of
+            # these were already picked up by index_channel, and get skipped by
+            # index_messages. Keep the channel marked as re-indexing until
+            # we're done, so these can't race with newer messages.
+            while deferred := self.reindexing_channels[channel_id]:
+                self.reindexing_channels[channel_id] = []
+                # if we dropped messages again in the meantime, the channel
+                # gets re-indexed again, which will pick these up as well.
+                if channel_id in self.overflowed_channels:
+                    break
+                await self.index_messages(deferred)
+        except Exception as e:
+            err = "".join(traceback.format_exception(e))
+            await self.error_log_channel.send(f"Ignoring exception while "
+                f"re-indexing overflowed channel {discord_channel} / "
+                f"{channel_id}: \n```\n{err}\n```")
+        finally:
+            del self.reindexing_channels[channel_id]
+            del self.reindex_tasks[channel_id]
+
+    async def index_messages(self, messages):
+        events = []
+        # channel id to the most recent message id we indexed in that channel
+        last_indexed = {}
+
+        for message in messages:
+            channel_id = message.channel.id
+            snitch_channel = self.get_snitch_channel(channel_id)
+
+            # only index messages in snitch channels which have been fully
+            # indexed by `.index` already. If someone adds a snitch channel with
+            # `.add-channel #snitches`, and then a snitch ping is immediately
+            # sent in that channel, we don't want to update the last indexed id
+            # (or index the message at all) until the channel has been fully
+            # indexed manually.
+            if not snitch_channel or not snitch_channel.last_indexed_id:
+                continue
 
             # consider the following:
             # * bot starts and on_ready is called. current snitch channels:
             #   [A B C].
-            # * self.defer_indexing = True
+            # * self.can_index is cleared
             # * snitch channels A B are indexed, but while they're indexed a
             #   new message M is sent to C. Since we're deferring indexing, M
             #   is added to indexing_queue.
@@ -144,76 +436,179 @@ class Snitchvis(Client):
             # not index any messages earlier than our last_indexed_id.
             # A more robust solution may be to remove messages from
             # indexing_queue when they get indexed by index_channel.
-            if snitch_channel and message.id <= snitch_channel.last_indexed_id:
+            if message.id <= snitch_channel.last_indexed_id:
                 continue
 
-            await self.maybe_index_message(message)
-
-        # now that we've indexed the channels and fully processed the queue, we
-        # can go back to indexing new messages normally.
-        self.defer_indexing = False
-
-        # on_ready can be called multiple times by discordpy, not just when
-        # the bot starts. Avoid an error by starting an already-started task.
-        if not self.check_outdated_livemaps.is_running(): # pylint: disable=no-member
-            self.check_outdated_livemaps.start() # pylint: disable=no-member
+            # snitch pings are always sent by kira (a bot). Skip anything
+            # from regular users before trying to parse it.
+            if not message.author.bot:
+                continue
 
-    async def on_message(self, message):
-        await super().on_message(message)
-        if not self.defer_indexing:
-            await self.maybe_index_message(message)
-        else:
-            self.indexing_queue.put_nowait(message)
+            try:
+                event = self.parse_event(message.content, message.guild.id)
+            except InvalidEventException:
+                continue
 
-    async def maybe_index_message(self, message):
-        snitch_channel = db.get_snitch_channel(message.channel.id)
-        # only index messages in snitch channels which have been fully indexed
-        # by `.index` already. If someone adds a snitch channel with
-        # `.add-channel #snitches`, and then a snitch ping is immediately sent
-        # in that channel, we don't want to update the last indexed id (or
-        # index the message at all) until the channel has been fully indexed
-        # manually.
-        if not snitch_channel or not snitch_channel.last_indexed_id:
-            return
+            events.append([message, event])
+            last_indexed[channel_id] = max(message.id,
+                last_indexed.get(channel_id, 0))
 
-        # this will retrieve kira configs on every snitch message...we probably
-        # want to cache these? but eh, the db hits are so cheap for now and I
-        # don't want to deal with cache invalidation.
-        kira_configs = db.get_kira_configs(message.guild.id)
-        try:
-            event = self.parse_event(message.content, kira_configs)
-        except InvalidEventException:
+        if not events:
             return
 
-        db.add_event(message, event)
-        db.update_last_indexed(message.channel.id, message.id)
+        # the events and last indexed ids are committed together, so if we go
+        # down before committing, we'll index the messages again on startup.
+        await db.add_events_bulk(events, last_indexed=last_indexed)
+        for (channel_id, message_id) in last_indexed.items():
+            # the cached channel may have been invalidated (or the channel
+            # removed) while we were writing. It'll be reloaded from the db
+            # the next time we need it.
+            snitch_channel = self.snitch_channels.get(channel_id)
+            if snitch_channel:
+                snitch_channel.last_indexed_id = message_id
+
+        self.update_snitches(events)
+        guild_ids = {message.guild.id for (message, _event) in events}
+
+        # update the livemaps of any guild which got new events. This happens in
+        # the background so rendering livemaps doesn't hold up indexing.
+        for guild_id in guild_ids:
+            lm_channel = self.get_livemap_channel(guild_id)
+            if not lm_channel:
+                continue
+            self.request_livemap_update(lm_channel)
 
-        # update all the livemaps of the guild
-        lm_channel = db.get_livemap_channel(message.guild.id)
-        if not lm_channel:
-            return
-        await self.update_livemap_channel(lm_channel)
+    def request_livemap_update(self, lm_channel, refresh=True):
+        channel_id = lm_channel.channel_id
+        # if new events and a scheduled refresh coalesce into one update, we
+        # still need to schedule refreshes for the new events.
+        if channel_id in self.livemap_pending:
+            refresh = refresh or self.livemap_pending[channel_id][1]
+        self.livemap_pending[channel_id] = (lm_channel, refresh)
+
+        task = self.livemap_tasks.get(channel_id)
+        if task is None or task.done():
+            task = asyncio.create_task(self.process_livemap_updates(channel_id))
+            self.livemap_tasks[channel_id] = task
+
+    async def process_livemap_updates(self, channel_id):
+        # keep updating the livemap until no new update has been requested
+        # since the last one started.
+        while channel_id in self.livemap_pending:
+            (lm_channel, refresh) = self.livemap_pending.pop(channel_id)
+            try:
+                await self.update_livemap_channel(lm_channel, refresh=refresh)
+            except Exception as e:
+                err = "".join(traceback.format_exception(e))
+                await self.error_log_channel.send("Ignoring exception in "
+                    f"livemap update: \n```\n{err}\n```")
+
+    async def get_snitches(self, guild_id, roles):
+        # `roles` is either a list of discord roles or "all", as in
+        # db.get_events.
+        roles_key = "all" if roles == "all" else frozenset(r.id for r in roles)
+        key = (guild_id, roles_key)
+
+        if key not in self.snitches:
+            generation = self.snitches_generation[guild_id]
+            # use all events these roles have access to to construct snitches,
+            # instead of just the events being rendered. We only need one
+            # event per snitch for this, not all of them.
+            snitch_events = await db.get_snitch_events(guild_id, roles)
+            snitches = snitches_from_events(snitch_events)
+            # if the guild has any snitches uploaded (via .import-snitches), use
+            # those as well, even if they've never been pinged.
+            # Only retrieve snitches which the roles have access to.
+            snitches |= set(db.get_snitches(guild_id, roles))
+            # if the guild's snitches changed while we were reading, our result
+            # might not include the change. Use it this once, but don't cache
+            # it.
+            if self.snitches_generation[guild_id] != generation:
+                return snitches
+            self.snitches[key] = snitches
+            # evict the least recently used entry. Dicts keep insertion order,
+            # and hits are moved to the end below.
+            if len(self.snitches) > self.SNITCH_CACHE_SIZE:
+                del self.snitches[next(iter(self.snitches))]
+        else:
+            self.snitches[key] = self.snitches.pop(key)
+
+        # return a copy so callers can't modify our cache
+        return set(self.snitches[key])
+
+    def update_snitches(self, events):
+        # incrementally add the snitches of newly indexed events to any cached
+        # snitch sets which can see them, instead of invalidating the cache and
+        # recomputing from every event in the guild on the next render.
+        # `events` is a list of (message, event) tuples.
+        for (message, event) in events:
+            # the channel may have been removed since these were indexed
+            snitch_channel = self.get_snitch_channel(message.channel.id)
+            if not snitch_channel:
+                continue
+            allowed_roles = snitch_channel.allowed_roles
+            new_snitches = snitches_from_events([event])
+            self.snitches_generation[message.guild.id] += 1
+            for ((guild_id, roles_key), snitches) in self.snitches.items():
+                if guild_id != message.guild.id:
+                    continue
+                if roles_key != "all" and roles_key.isdisjoint(allowed_roles):
+                    continue
+                # prefer the snitch from the most recent event, like
+                # db.get_snitch_events does
+                snitches -= new_snitches
+                snitches |= new_snitches
+
+    def invalidate_snitches(self, guild_id):
+        self.snitches_generation[guild_id] += 1
+        for key in list(self.snitches):
+            if key[0] == guild_id:
+                del self.snitches[key]
+
+    def get_snitch_channel(self, channel_id):
+        if channel_id not in self.snitch_channels:
+            self.snitch_channels[channel_id] = db.get_snitch_channel(channel_id)
+        return self.snitch_channels[channel_id]
+
+    def get_kira_configs(self, guild_id):
+        if guild_id not in self.kira_configs:
+            # Always try the default kira config first.
+            configs = [DEFAULT_KIRA_CONFIG, *db.get_kira_configs(guild_id)]
+            self.kira_configs[guild_id] = configs
+            self.kira_prefixes[guild_id] = tuple({c.prefix for c in configs})
+        return self.kira_configs[guild_id]
+
+    def get_livemap_channel(self, guild_id):
+        if guild_id not in self.livemap_channels:
+            lm_channel = db.get_livemap_channel(guild_id)
+            self.livemap_channels[guild_id] = lm_channel
+        return self.livemap_channels[guild_id]
 
     @loop(seconds=10)
     async def check_outdated_livemaps(self):
         try:
-            now = utcnow()
-            for channel_id, refresh_at in self.livemaps_refresh_at.copy().items():
-                # if any of the datetimes in `refresh_at` have passed - no matter
-                # how many - we'll refresh the livemap. Afterwards, we'll remove
-                # them from the list so we don't refresh on them again.
-                future_dts = [dt for dt in refresh_at if now < dt]
-                if future_dts == refresh_at:
+            now = time.monotonic()
+            heap = self.livemap_refresh_heap
+            # if any of a channel's refresh times have passed - no matter how
+            # many - we'll refresh its livemap once. Popping them means we
+            # won't refresh on them again.
+            channel_ids = set()
+            while heap and heap[0][0] <= now:
+                (_t, channel_id, generation) = heappop(heap)
+                if generation != self.livemap_refresh_generation[channel_id]:
                     continue
+                channel_ids.add(channel_id)
 
-                self.livemaps_refresh_at[channel_id] = future_dts
+            for channel_id in channel_ids:
                 lm_channel = db.get_livemap_channel_from_channel(channel_id)
                 if not lm_channel:
                     # I think this can happen if the livemap channel is deleted /
-                    # changed while livemaps_refresh_at still has entries for that
-                    # channel.
+                    # changed while livemap_refresh_heap still has entries for
+                    # that channel.
                     continue
-                await self.update_livemap_channel(lm_channel, refresh=False)
+                # like new events, refreshes happen in the background, so a slow
+                # render doesn't hold up refreshing other livemaps.
+                self.request_livemap_update(lm_channel, refresh=False)
         except Exception as e:
             err = "".join(traceback.format_exception(e))
             await self.error_log_channel.send(f"Ignoring exception in event "
@@ -224,27 +619,29 @@ class Snitchvis(Client):
 
         # avoid infinite refresh chains
         if refresh:
-            refresh_at = []
+            generation = self.livemap_refresh_generation.get(channel_id, 0) + 1
+            self.livemap_refresh_generation[channel_id] = generation
             # generate a new livemap every minute seconds for the next 10
             # minutes, so we get the nice fade effect even if there aren't any
             # new events. Also generate a new livemap 12 seconds from now to
             # clean up any missed events from debounce.
-            refresh_at.append(utcnow() + timedelta(seconds=12))
+            now = time.monotonic()
+            refresh_at = [now + 12]
             for i in range(1, 10 + 1):
-                dt = utcnow() + timedelta(seconds=i * 60)
-                refresh_at.append(dt)
+                refresh_at.append(now + i * 60)
 
-            self.livemaps_refresh_at[channel_id] = refresh_at
+            for t in refresh_at:
+                heappush(self.livemap_refresh_heap, (t, channel_id, generation))
 
         if channel_id in self.livemap_last_uploaded:
             last_uploaded = self.livemap_last_uploaded[channel_id]
             # debounce of 10 seconds so people don't get annoyed at the image
             # they're looking at getting deleted every 2 seconds
-            if last_uploaded > utcnow() - timedelta(seconds=10):
+            if time.monotonic() - last_uploaded < 10:
                 return
 
         await self.update_livemap(lm_channel)
-        self.livemap_last_uploaded[channel_id] = utcnow()
+        self.livemap_last_uploaded[channel_id] = time.monotonic()
 
 
     async def update_livemap(self, lm_channel):
@@ -252,7 +649,7 @@ class Snitchvis(Client):
         # duplicate events
         if lm_channel.channel_id in self.livemap_updating_channels:
             return
-        self.livemap_updating_channels.append(lm_channel.channel_id)
+        self.livemap_updating_channels.add(lm_channel.channel_id)
 
         try:
             await self._update_livemap(lm_channel)
@@ -269,7 +666,7 @@ class Snitchvis(Client):
             #
             # since livemaps run so often, it's important they're robust to
             # rare discord errors.
-            self.livemap_updating_channels.remove(lm_channel.channel_id)
+            self.livemap_updating_channels.discard(lm_channel.channel_id)
 
     async def _update_livemap(self, lm_channel):
         channel = self.get_channel(lm_channel.channel_id)
@@ -282,16 +679,12 @@ class Snitchvis(Client):
         # for now we'll just render all events to the livemap, eventually we may
         # want to support different livemap channels with granular role-based
         # snitch vision
-        start = (utcnow() - timedelta(minutes=10)).timestamp()
-        events = db.get_events(guild.id, "all", start=start)
+        start = time.time() - 10 * 60
+        events = await db.get_events(guild.id, "all", start=start)
 
         # use all events to construct snitches instead of the filtered subset
         # above
-        all_events = db.get_events(guild.id, "all", convert_t=False)
-        snitches = snitches_from_events(all_events)
-        # reclaim memory.
-        del all_events
-        snitches |= set(db.get_snitches(guild.id, "all"))
+        snitches = await self.get_snitches(guild.id, "all")
         users = create_users(events)
 
         with TemporaryDirectory() as d:
@@ -300,97 +693,155 @@ class Snitchvis(Client):
             config = Config(snitches=snitches, events=events, users=users)
             f = partial(run_image_render, output_file, config)
 
-            with ProcessPoolExecutor() as pool:
-                await self.loop.run_in_executor(pool, f)
+            await self.loop.run_in_executor(self.livemap_pool, f)
 
-            livemap_file = File(output_file)
+            # read the image once for both uploads
+            image = Path(output_file).read_bytes()
+            livemap_file = File(BytesIO(image), filename="livemap.jpg")
             await channel.send(file=livemap_file)
 
             # upload a log to our log category if we have one
             log_channel = db.get_livemap_log_channel(guild.id)
             if log_channel:
                 log_channel = self.get_channel(log_channel.log_channel_id)
-                log_file = File(output_file)
+                log_file = File(BytesIO(image), filename="livemap.jpg")
                 await log_channel.send(file=log_file)
 
-    async def index_channel(self, channel, discord_channel, *, update_message=None):
+    async def index_channel(self, channel, discord_channel, *, progress=None):
+        # `progress` is an optional coroutine function, called with the number
+        # of events added so far every so often.
         print(f"Indexing channel {discord_channel} / {discord_channel.id}, "
             f"guild {discord_channel.guild} / {discord_channel.guild.id}")
         num_events = 0
-        events = []
         last_id = channel.last_indexed_id
-        kira_configs = db.get_kira_configs(discord_channel.guild.id)
+        # parsed events are written to the db by a separate consumer task in
+        # batches, so writing one batch can overlap with waiting on discord for
+        # the next page of history. Bounded so we never hold more than a few
+        # batches worth of messages in memory. A `None` signals the end of the
+        # channel.
+        events_queue = Queue(maxsize=self.INDEX_BATCH_SIZE * 2)
+
+        async def write_events():
+            nonlocal num_events
+            while True:
+                # wait for at least one event, then take whatever else is
+                # available, up to a full batch.
+                events = [await events_queue.get()]
+                while len(events) < self.INDEX_BATCH_SIZE:
+                    try:
+                        events.append(events_queue.get_nowait())
+                    except QueueEmpty:
+                        break
+
+                # the end-of-channel sentinel is always the final item
+                finished = events[-1] is None
+                if finished:
+                    events.pop()
+
+                if events:
+                    await db.add_events_bulk(events)
+                    num_events += len(events)
+                    if progress:
+                        await progress(num_events)
+
+                if finished:
+                    return
 
-        async for message_ in discord_channel.history(limit=None):
-            # don't index past the last indexed message id (if we have such
-            # an id stored)
-            if last_id and message_.id <= last_id:
-                break
+        writer = asyncio.create_task(write_events())
 
+        async def put(item):
             try:
-                event = self.parse_event(message_.content, kira_configs)
-            except InvalidEventException:
-                continue
-            events.append([message_, event])
-            num_events += 1
-
-            if len(events) >= 1_000:
-                if update_message:
-                    content = f"Indexing {discord_channel.mention}... added {num_events:,} new events so far"
-                    embed = utils.create_embed(content)
-                    try:
-                        await update_message.edit(embed=embed)
-                    except Exception as e:
-                        # Users have run into "connection reset by peer" while
-                        # indexing. I suspect this edit call is where it occured.
-                        # Indexing can be very costly to restart, so we need to
-                        # be resilient here.
-                        #
-                        # TODO we should retry this at a lower level, for all
-                        # messages. Replace message with our own class that
-                        # redefines anything awaitable (edit, etc) and retries
-                        # exceptions.
-
-                        err = "".join(traceback.format_exception(e))
-                        await self.error_log_channel.send(f"Ignoring exception while "
-                            f"updating index progress message: \n```\n{err}\n```")
-                        # give any connection issues some time to resolve
-                        # themselves.
-                        await asyncio.sleep(5)
-
-                # batch commit
-                for (message_, event) in events:
-                    db.add_event(message_, event, commit=False)
-                db.commit()
-                events = []
-
-        # commit any stragglers
-        for (message_, event) in events:
-            db.add_event(message_, event, commit=False)
-        db.commit()
-
-        # update last_indexed (if the channel has messages at all)
-        last_messages = [m async for m in discord_channel.history(limit=1)]
-        if last_messages:
-            last_message = last_messages[0]
-            db.update_last_indexed(channel.id, last_message.id)
+                events_queue.put_nowait(item)
+                return
+            except QueueFull:
+                pass
+            # the queue only stays full if the writer is behind - or dead. If
+            # the writer died, nothing will ever make room, so stop waiting and
+            # raise its exception instead.
+            put_task = asyncio.ensure_future(events_queue.put(item))
+            try:
+                done, _pending = await asyncio.wait({put_task, writer},
+                    return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                put_task.cancel()
+            if put_task not in done:
+                writer.result()
+
+        # only ask discord for messages after the last indexed message id (if we
+        # have such an id stored), instead of walking backwards from the newest
+        # message until we hit it.
+        last_message_id = None
+        try:
+            async for data in self.raw_history(discord_channel, after=last_id):
+                last_message_id = int(data["id"])
+                # see index_messages
+                if not data["author"].get("bot"):
+                    continue
+                try:
+                    event = self.parse_event(data["content"],
+                        discord_channel.guild.id)
+                except InvalidEventException:
+                    continue
+                # only build a full discord message for messages which are
+                # actually events. Building one is relatively expensive, and
+                # most messages aren't events.
+                message_ = Message(state=discord_channel._state,
+                    channel=discord_channel, data=data)
+                await put([message_, event])
+            await put(None)
+        except BaseException:
+            writer.cancel()
+            raise
+
+        await writer
+
+        if num_events:
+            self.invalidate_snitches(discord_channel.guild.id)
+
+        # update last_indexed (if we saw any new messages at all). Since we
+        # iterate oldest first, the last message we saw is the most recent one.
+        if last_message_id:
+            db.update_last_indexed(channel.id, last_message_id)
+            self.snitch_channels.pop(channel.id, None)
 
         return num_events
 
-    def parse_event(self, raw_event, kira_configs):
-        # we'll try all the available configs in order. If none of them match
-        # the event, we'll raise an InvalidEventException.
-        # Always try the default kira config first.
-        for kira_config in [self.default_kira_config] + kira_configs:
-            snitch = kira_config.snitch_format
-            enter = kira_config.snitch_enter_message
-            login = kira_config.snitch_login_message
-            logout = kira_config.snitch_logout_message
-            time = kira_config.time_format
+    async def raw_history(self, discord_channel, *, after=None):
+        # like discord_channel.history(limit=None, after=after,
+        # oldest_first=True), but yields the raw message payloads from discord
+        # instead of discord.Message objects, which we may not need.
+        http = discord_channel._state.http
+        # discord treats after=0 as the beginning of the channel
+        after = after or 0
+        while True:
+            # 100 is the maximum number of messages discord will return at once
+            data = await http.logs_from(discord_channel.id, 100, after=after)
+            if not data:
+                return
+            # discord returns messages newest first
+            data.sort(key=lambda d: int(d["id"]))
+            for d in data:
+                yield d
+            if len(data) < 100:
+                return
+            after = int(data[-1]["id"])
+
+    def parse_event(self, raw_event, guild_id):
+        # we'll try all the available configs for the guild in order. If none
+        # of them match the event, we'll raise an InvalidEventException.
+        kira_configs = self.get_kira_configs(guild_id)
+        content = raw_event.lstrip()
+        # most messages aren't events. Reject them in a single check instead of
+        # once per config.
+        if not content.startswith(self.kira_prefixes[guild_id]):
+            raise InvalidEventException("no kira config prefixes match")
+
+        for kira_config in kira_configs:
+            if not content.startswith(kira_config.prefix):
+                continue
 
             try:
-                event = Event.parse(raw_event, snitch, enter, login, logout,
-                    time)
+                event = Event.parse(raw_event, *kira_config.formats)
             except InvalidEventException:
                 # this config didn't work, try the next one
                 continue
@@ -399,9 +850,16 @@ class Snitchvis(Client):
 
         raise InvalidEventException("all kira configs failed")
 
-    async def export_to_sql(self, path, snitches, events):
-        conn = sqlite3.connect(str(path))
+    def export_to_sql(self, snitches, events):
+        # returns the exported database as bytes. The database is built in
+        # memory, since we only need it long enough to compress and upload it.
+        # Building it takes a while for large exports, so call this off the
+        # event loop.
+        conn = sqlite3.connect(":memory:")
         c = conn.cursor()
+        # this database gets thrown away if anything goes wrong, so there's no
+        # need to pay for a rollback journal.
+        c.execute("PRAGMA journal_mode = OFF")
 
         c.execute(
             """
@@ -442,14 +900,10 @@ class Snitchvis(Client):
             )
             """
         )
-        c.execute("""
-            CREATE UNIQUE INDEX snitch_world_x_y_z_unique
-            ON snitch(world, x, y, z);
-        """)
         conn.commit()
 
-        for snitch in snitches:
-            args = [
+        snitch_rows = (
+            [
                 snitch.world, snitch.x, snitch.y, snitch.z,
                 snitch.group_name, snitch.type, snitch.name,
                 snitch.dormant_ts, snitch.cull_ts, snitch.first_seen_ts,
@@ -458,18 +912,52 @@ class Snitchvis(Client):
                 snitch.renamed_by_uuid, snitch.lost_jalist_access_ts,
                 snitch.broken_ts, snitch.gone_ts, snitch.tags, snitch.notes
             ]
-            # ignore duplicate snitches
-            c.execute("INSERT OR IGNORE INTO snitch VALUES (?, ?, ?, ?, ?, "
-                "?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", args)
-
-        for event in events:
-            args = [
+            # Snitch hashes and compares by location, so this drops duplicate
+            # snitches (keeping the first) the same way the unique index would.
+            for snitch in dict.fromkeys(snitches)
+        )
+        event_rows = (
+            [
                 event.username, event.snitch_name, event.namelayer_group,
                 event.x, event.y, event.z, event.t.timestamp()
             ]
-            c.execute("INSERT INTO event VALUES (?, ?, ?, ?, ?, ?, ?)", args)
-        conn.commit()
+            for event in events
+        )
 
+        def insert(table, num_columns, rows):
+            # inserts up to 500 rows per statement with a multi-row VALUES
+            # clause, which is noticeably faster than one row per statement
+            # even with executemany. Leftover rows are inserted one at a time.
+            # Older versions of sqlite only allow 999 parameters per statement.
+            max_params = conn.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+            chunk_size = min(500, max_params // num_columns)
+            row_qs = "(" + ("?, " * num_columns)[:-2] + ")"
+            chunk_query = (f"INSERT INTO {table} VALUES "
+                + ", ".join([row_qs] * chunk_size))
+            params = []
+            for row in rows:
+                params += row
+                if len(params) == num_columns * chunk_size:
+                    c.execute(chunk_query, params)
+                    params = []
+
+            leftover = [params[i:i + num_columns]
+                for i in range(0, len(params), num_columns)]
+            c.executemany(f"INSERT INTO {table} VALUES {row_qs}", leftover)
+
+        # both inserts happen in a single transaction, committed below.
+        insert("snitch", 20, snitch_rows)
+        insert("event", 7, event_rows)
+        # building the index once after loading is cheaper than maintaining it
+        # on every insert.
+        c.execute("""
+            CREATE UNIQUE INDEX snitch_world_x_y_z_unique
+            ON snitch(world, x, y, z);
+        """)
+        conn.commit()
+        data = conn.serialize()
+        conn.close()
+        return data
 
     @command("tutorial",
         help="Walks you through an initial setup of snitchvis."
@@ -541,6 +1029,8 @@ class Snitchvis(Client):
                 "the desired roles.")
             return
         db.add_snitch_channel(channel, roles)
+        self.snitch_channels.pop(channel.id, None)
+        self.invalidate_snitches(message.guild.id)
 
         await message.channel.send(f"Added {channel.mention} to snitch "
             f"channels, accessible by {utils.role_str(roles)}")
@@ -559,6 +1049,8 @@ class Snitchvis(Client):
     async def channel_remove(self, message, channels):
         for channel in channels:
             db.remove_snitch_channel(channel.id)
+            self.snitch_channels.pop(channel.id, None)
+        self.invalidate_snitches(message.guild.id)
 
         await message.channel.send(f"Removed {utils.channel_str(channels)} "
             "from snitch channels.")
@@ -579,10 +1071,10 @@ class Snitchvis(Client):
                 "snitch channels with `.add-channel`.")
             return
 
-        m = "Current snitch channels:\n"
-        for channel in channels:
-            m += f"\n{utils.channel_accessible(message.guild, channel)}"
-        await message.channel.send(m)
+        lines = [utils.channel_accessible(message.guild, channel)
+            for channel in channels]
+        await message.channel.send("Current snitch channels:\n\n" +
+            "\n".join(lines))
 
 
     @command("index",
@@ -590,15 +1082,22 @@ class Snitchvis(Client):
         permissions=["manage_guild"]
     )
     async def index(self, message):
-        channels = db.get_snitch_channels(message.guild.id)
-
-        for channel in channels:
-            if channel.to_discord(message.guild) is None:
+        channels = []
+        # snitch channel to discord channel, so we only have to look each one
+        # up once
+        discord_channels = {}
+        for channel in db.get_snitch_channels(message.guild.id):
+            c = channel.to_discord(message.guild)
+            if c is None:
                 await message.channel.send("Removing deleted channel "
                     f"(id {channel.id}) from snitch channels. No action is "
                     "necessary.")
-                channels.remove(channel)
                 db.remove_snitch_channel(channel.id)
+                self.snitch_channels.pop(channel.id, None)
+                self.invalidate_snitches(message.guild.id)
+                continue
+            channels.append(channel)
+            discord_channels[channel] = c
 
         if not channels:
             await message.channel.send("No snitch channels to index. Use "
@@ -620,29 +1119,105 @@ class Snitchvis(Client):
             f"{utils.channel_str(channels)}. This could take a LONG time "
             "(hours) if you have lots of snitch hits stored.")
 
-        for channel in channels:
-            # make sure we can read all the snitch channels
-            c = channel.to_discord(message.guild)
-            permissions = c.permissions_for(message.guild.me)
-            if not permissions.read_messages:
-                await message.channel.send("Snitchvis doesn't have permission "
-                    f"to read messages in {channel.mention}. Either give "
-                    "snitchvis enough permissions to read messages there, or "
-                    "remove it from the list of snitch channels (with "
-                    "`.remove-channel`).")
-                return
+        # make sure we can read all the snitch channels
+        unreadable = [channel for channel in channels
+            if not discord_channels[channel].permissions_for(
+                message.guild.me).read_messages]
+        for channel in unreadable:
+            await message.channel.send("Snitchvis doesn't have permission "
+                f"to read messages in {channel.mention}. Either give "
+                "snitchvis enough permissions to read messages there, or "
+                "remove it from the list of snitch channels (with "
+                "`.remove-channel`).")
+        if unreadable:
+            return
 
-        self.indexing_guilds.append(message.guild.id)
+        self.indexing_guilds.add(message.guild.id)
         try:
-            for channel in channels:
-                update_message = await message.channel.send(f"Indexing {channel.mention}...")
-                c = channel.to_discord(message.guild)
-                num_events = await self.index_channel(channel, c, update_message=update_message)
-
-                content = (f"Finished indexing {channel.mention} "
-                    f"({num_events:,} new events added)")
-                embed = utils.create_embed(content)
-                await update_message.edit(embed=embed)
+            # report progress for all channels in a single status message,
+            # instead of a message per channel. Edits are throttled to at most
+            # one every INDEX_PROGRESS_INTERVAL seconds so we don't get
+            # ratelimited when indexing lots of channels at once.
+            # channel to status text
+            statuses = {channel: "waiting..." for channel in channels}
+            last_edit = 0
+
+            def status_content():
+                return "\n".join(f"{channel.mention}: {status}"
+                    for (channel, status) in statuses.items())
+
+            status_message = await message.channel.send(
+                embed=utils.create_embed(status_content()))
+
+            async def edit_status(*, force=False):
+                nonlocal last_edit
+                now = time.monotonic()
+                if not force and now - last_edit < self.INDEX_PROGRESS_INTERVAL:
+                    return
+                last_edit = now
+
+                embed = utils.create_embed(status_content())
+                try:
+                    await status_message.edit(embed=embed)
+                except Exception as e:
+                    # Users have run into "connection reset by peer" while
+                    # indexing. I suspect this edit call is where it occured.
+                    # Indexing can be very costly to restart, so we need to
+                    # be resilient here.
+                    #
+                    # TODO we should retry this at a lower level, for all
+                    # messages. Replace message with our own class that
+                    # redefines anything awaitable (edit, etc) and retries
+                    # exceptions.
+
+                    err = "".join(traceback.format_exception(e))
+                    await self.error_log_channel.send(f"Ignoring exception while "
+                        f"updating index progress message: \n```\n{err}\n```")
+                    # give any connection issues some time to resolve
+                    # themselves.
+                    await asyncio.sleep(5)
+
+            # indexing is bound by discord's history api latency, not by us, so
+            # index several channels at once. Limit how many at once so we don't
+            # run straight into discord's ratelimits.
+            sem = asyncio.Semaphore(self.MAXIMUM_CONCURRENT_INDEXES)
+
+            async def _index(channel):
+                async def progress(num_events):
+                    statuses[channel] = (f"indexing... added {num_events:,} new "
+                        "events so far")
+                    await edit_status()
+
+                async with sem:
+                    statuses[channel] = "indexing..."
+                    await edit_status()
+                    try:
+                        num_events = await self.index_channel(channel,
+                            discord_channels[channel], progress=progress)
+                    except Exception:
+                        statuses[channel] = "failed"
+                        raise
+
+                statuses[channel] = f"finished ({num_events:,} new events added)"
+                await edit_status()
+
+            # don't let one channel failing stop us from indexing the others
+            results = await asyncio.gather(*(_index(channel)
+                for channel in channels), return_exceptions=True)
+            # make sure the final counts are shown, even if we skipped the last
+            # few edits due to throttling
+            await edit_status(force=True)
+
+            exceptions = [r for r in results if isinstance(r, Exception)]
+            for e in exceptions:
+                err = "".join(traceback.format_exception(e))
+                await self.error_log_channel.send(f"Ignoring exception while "
+                    f"indexing: \n```\n{err}\n```")
+            if exceptions:
+                await message.channel.send("Something went wrong while "
+                    "indexing some snitch channels. You can safely re-run "
+                    "`.index` to try again.")
+                return
 
             await message.channel.send("Finished indexing snitch channels")
         finally:
@@ -651,12 +1226,16 @@ class Snitchvis(Client):
             # errors to occur when indexing here. We probably need to defer
             # indexing for a specific guild while an .index command is running
             # in that guild.
-            self.indexing_guilds.remove(message.guild.id)
+            self.indexing_guilds.discard(message.guild.id)
 
     @command("full-reindex",
         args=[
             Arg("-y", store_boolean=True, help="Pass to confirm you would like "
-            "to reindex the server.")
+            "to reindex the server."),
+            Arg("--since", convert=human_timedelta, help="Only drop and "
+                "re-index events from this far in the past, instead of all "
+                "events. Any human-recognizable format will work, such as "
+                "--since 2d.", arg_help="<duration>")
         ],
         help="Drops all currently indexed snitches and re-indexes from "
             "scratch. This can help with some rare issues. You probably don't "
@@ -666,7 +1245,7 @@ class Snitchvis(Client):
             "scratch.",
         permissions=["manage_guild"]
     )
-    async def full_reindex(self, message, y):
+    async def full_reindex(self, message, y, since):
         if not y:
             await message.channel.send("This command will delete all currently "
                 "indexed snitches and will re-index from scratch. This can "
@@ -675,13 +1254,37 @@ class Snitchvis(Client):
                 "to do so by tybug. If you're sure you would like to reindex, "
                 "run `.full-reindex -y`.")
             return
-        await message.channel.send("Dropping all events and resetting last "
-            "indexed ids")
-        # drop all events
-        db.execute("DELETE FROM event WHERE guild_id = ?", [message.guild.id])
-        # reset last indexed id so indexing works from scratch again
-        db.execute("UPDATE snitch_channel SET last_indexed_id = null "
-            "WHERE guild_id = ?", [message.guild.id])
+        if since is None or since == "all":
+            await message.channel.send("Dropping all events and resetting last "
+                "indexed ids")
+            await db.write([
+                # drop all events
+                ("DELETE FROM event WHERE guild_id = ?", [[message.guild.id]]),
+                # reset last indexed id so indexing works from scratch again
+                ("UPDATE snitch_channel SET last_indexed_id = null "
+                    "WHERE guild_id = ?", [[message.guild.id]])
+            ])
+        else:
+            await message.channel.send("Dropping events from the past "
+                f"{since} and resetting last indexed ids")
+            cutoff = utcnow() - since
+            await db.write([
+                ("DELETE FROM event WHERE guild_id = ? AND t >= ?",
+                    [[message.guild.id, cutoff.timestamp()]]),
+                # pretend we've only indexed up to the cutoff, so indexing picks
+                # up from there instead of from the beginning of the channel.
+                # Channels which were only indexed up to some point before the
+                # cutoff keep their last indexed id, so we don't skip the
+                # messages in between. Leave channels which were never indexed
+                # alone, those still need a full index.
+                ("UPDATE snitch_channel "
+                    "SET last_indexed_id = MIN(last_indexed_id, ?) "
+                    "WHERE guild_id = ? AND last_indexed_id IS NOT NULL",
+                    [[time_snowflake(cutoff), message.guild.id]])
+            ])
+        for channel in db.get_snitch_channels(message.guild.id):
+            self.snitch_channels.pop(channel.id, None)
+        self.invalidate_snitches(message.guild.id)
         # finally, reindex.
         await self.index(message)
 
@@ -767,6 +1370,8 @@ class Snitchvis(Client):
         NO_EVENTS = ("No events match those criteria. Try adding snitch "
             "channels with `.add-channel #channel`, indexing with `.index`, or "
             "adjusting your parameters to include more snitch events.")
+        # read the clock once, so every time window in this command agrees
+        now = time.time()
 
         if heatmap_percentage < 1:
             await message.channel.send("Cannot use a heatmap percentage lower "
@@ -787,7 +1392,7 @@ class Snitchvis(Client):
             return
 
         if past:
-            end = utcnow().timestamp()
+            end = now
             if past == "all":
                 # conveniently, start of epoch is 0 ms
                 start = 0
@@ -814,7 +1419,7 @@ class Snitchvis(Client):
             elif start and not end:
                 # only start set. Set end to current date
                 start = start.timestamp()
-                end = utcnow().timestamp()
+                end = now
             elif end and not start:
                 # only end set. Set start to beginning of time
                 start = 0
@@ -829,27 +1434,15 @@ class Snitchvis(Client):
             return
 
         # TODO warn if no events by the specified users are in the events filter
-        events = db.get_events(message.guild.id, message.author.roles,
+        events = await db.get_events(message.guild.id, message.author.roles,
             start=start, end=end, users=users, groups=groups)
 
         if not events:
             await message.channel.send(NO_EVENTS)
             return
 
-        # use all events this author has access to to construct snitches,
-        # instead of just the events returned by the filter
-        all_events = db.get_events(message.guild.id, message.author.roles,
-            convert_t=False)
-        snitches = snitches_from_events(all_events)
-        # reclaim some memory since we don't need all_events anymore.
-        # TODO we may want to load events one by one
-        # instead of holding them all in memory at once.
-        del all_events
-        # if the guild has any snitches uploaded (via .import-snitches), use
-        # those as well, even if they've never been pinged.
-        # Only retrieve snitches which the author has access to via their roles
-        snitches |= set(db.get_snitches(message.guild.id, message.author.roles))
-        users = create_users(events)
+        snitches = await self.get_snitches(message.guild.id,
+            message.author.roles)
 
         if anonymize is not None:
             # associate each unique (x, y) with a specific randomzied x offset
@@ -875,8 +1468,15 @@ class Snitchvis(Client):
             # after all creation has taken place.
             for event in events:
                 _anonymize(event)
+            # snitches are shared with our snitch cache, so anonymize copies
+            # instead of the cached snitches themselves. Snitches hash by
+            # location, so anonymize each one before it goes into the set.
+            anonymized_snitches = set()
             for snitch in snitches:
+                snitch = copy(snitch)
                 _anonymize(snitch)
+                anonymized_snitches.add(snitch)
+            snitches = anonymized_snitches
 
         if only_pinged:
             # filter snitches to only those with at least one associated
@@ -887,25 +1487,23 @@ class Snitchvis(Client):
         if export == "sql":
             await message.channel.send("Exporting specified events to a "
                 "database...")
-            with TemporaryDirectory() as d:
-                d = Path(d)
-                p = d / "snitchvis_export.sqlite"
-                zipped_p = d / "snitchvis_export.sqlite.gz"
-                await self.export_to_sql(p, snitches, events)
-
-                # compress with gzip
-                with open(p, "rb") as f_in:
-                    with gzip.open(zipped_p, "wb") as f_out:
-                        f_out.writelines(f_in)
-
-                sql_file = File(zipped_p)
-                # 8mb in bytes
-                if zipped_p.stat().st_size >= 8_000_000:
-                    await message.channel.send("The sql file is over 8mb in "
-                        "size and can't be uploaded, sorry! Please contact "
-                        "tybug and ask for a manual export.")
-                else:
-                    await message.channel.send(file=sql_file)
+            data = await asyncio.to_thread(self.export_to_sql, snitches,
+                events)
+            # compress with gzip, also off the event loop since this can take a
+            # while for large exports. Level 6 gets nearly all of level 9's
+            # ratio on our (very repetitive) databases, in much less time.
+            data = await asyncio.to_thread(gzip.compress, data,
+                compresslevel=6)
+
+            # 8mb in bytes
+            if len(data) >= 8_000_000:
+                await message.channel.send("The sql file is over 8mb in "
+                    "size and can't be uploaded, sorry! Please contact "
+                    "tybug and ask for a manual export.")
+            else:
+                sql_file = File(BytesIO(data),
+                    filename="snitchvis_export.sqlite.gz")
+                await message.channel.send(file=sql_file)
             return
         if export == "svis":
             await message.channel.send("Exporting to a .svis file is not "
@@ -925,8 +1523,8 @@ class Snitchvis(Client):
                 "limits by contacting tybug.")
             return
 
-        start = (utcnow() - timedelta(days=1)).timestamp()
-        end = utcnow().timestamp()
+        start = now - timedelta(days=1).total_seconds()
+        end = now
         usage = db.get_pixel_usage(message.guild.id, start, end)
         if usage > self.PIXEL_LIMIT_DAY * multiplier:
             await message.channel.send("You've rendered more than 500 billion "
@@ -940,7 +1538,12 @@ class Snitchvis(Client):
         with TemporaryDirectory() as d:
             output_file = Path(d) / "render.mp4"
 
-            m_future = fire_later(message.channel.send("rendering video..."))
+            if self.render_semaphore.locked():
+                status = ("waiting for other renders to finish, then rendering "
+                    "video...")
+            else:
+                status = "rendering video..."
+            m_future = fire_later(message.channel.send(status))
 
             # seconds to ms
             duration *= 1000
@@ -966,11 +1569,13 @@ class Snitchvis(Client):
             # I dunno.
             # This memory leak is something I definitely should look into and
             # fix at some point, but I don't want to right now, so the temporary
-            # fix is sticking the visualization into a separate process and
-            # letting 100% of its memory get returned to the OS when it exits,
+            # fix is sticking the visualization into a separate process, whose
+            # memory gets returned to the OS when it exits (see render_pool),
             # since its only job is writing to an output mp4.
             # We are taking a slight hit on the event pickling, but hopefully
             # it's not too bad.
+            # only needed for rendering, so we don't build this for exports
+            users = create_users(events)
             config_ = Config(snitches=snitches, events=events, users=users,
                 show_all_snitches=all_snitches, mode=mode,
                 heatmap_percentage=heatmap_percentage,
@@ -980,9 +1585,12 @@ class Snitchvis(Client):
                 str(output_file), config_)
 
             self.concurrent_renders[message.guild.id] += 1
-            with ProcessPoolExecutor() as pool:
-                await self.loop.run_in_executor(pool, f)
-            self.concurrent_renders[message.guild.id] -= 1
+            try:
+                async with self.render_semaphore:
+                    pool = self.get_render_pool()
+                    await self.loop.run_in_executor(pool, f)
+            finally:
+                self.concurrent_renders[message.guild.id] -= 1
 
             vis_file = File(output_file)
             if output_file.stat().st_size >= 8_000_000:
@@ -991,19 +1599,20 @@ class Snitchvis(Client):
                     "you should use lower values for `--size`, `--fps`, "
                     "and/or `--duration`.")
                 m = await m_future
-                await m.delete()
+                fire_later(delete_message(m))
             else:
                 await message.channel.send(file=vis_file)
+                # cleaning up the status message doesn't need to hold up the
+                # rest of the command
                 m = await m_future
-                await m.delete()
+                fire_later(delete_message(m))
 
                 # don't log tests by myself
                 if message.author.id != config.AUTHOR_ID and self.command_log_channel:
                     vis_file = File(output_file)
                     fire_later(self.command_log_channel.send(file=vis_file))
 
-        db.add_render_history(message.guild.id, num_pixels,
-            utcnow().timestamp())
+        db.add_render_history(message.guild.id, num_pixels, time.time())
 
     @command("import-snitches",
         args=[
@@ -1035,53 +1644,63 @@ class Snitchvis(Client):
                 "in the same message as the `.import-snitches` command.")
             return
 
-        with NamedTemporaryFile() as f:
-            attachment = attachments[0]
-            await attachment.save(f.name)
-            conn = sqlite3.connect(f.name)
-            cur = conn.cursor()
-
-            for group in groups:
-                if group == "all":
-                    continue
-                # case insensitive group compare. nl groups are case insensitive
-                # in game.
-                row = cur.execute("SELECT COUNT(*) FROM snitches_v2 WHERE "
-                    "group_name = ? COLLATE NOCASE", [group]).fetchone()
-                if row[0] == 0:
-                    await message.channel.send("No snitches on namelayer "
-                        f"group `{group}` found in this database. If the "
-                        "group name is correct, omit it and re-run to "
-                        "avoid this error.")
-                    await message.channel.send("Import aborted. You may "
-                        "safely re-run this import with different "
-                        "arguments.")
-                    return
-
-            await message.channel.send("Importing snitches from snitchmod "
-                "database...")
+        # snitchmod databases are small enough to load straight into memory,
+        # instead of writing them to disk and reading them back.
+        attachment = attachments[0]
+        data = bytearray(await attachment.read())
+        # in-memory databases can't be in wal mode. If the uploaded database
+        # is, flip its header back to the legacy rollback journal format
+        # (bytes 18 and 19 are the file format read/write versions).
+        if data[18:20] == b"\x02\x02":
+            data[18:20] = b"\x01\x01"
+        conn = sqlite3.connect(":memory:")
+        conn.deserialize(data)
+        cur = conn.cursor()
+
+        # check that every group has snitches with a single scan over the
+        # database, instead of one scan per group.
+        named_groups = [group for group in groups if group != "all"]
+        found_groups = set()
+        if named_groups:
+            # case insensitive group compare. nl groups are case insensitive
+            # in game.
+            rows = cur.execute("SELECT DISTINCT group_name FROM "
+                "snitches_v2 WHERE group_name COLLATE NOCASE IN "
+                f"({('?, ' * len(named_groups))[:-2]})", named_groups)
+            # fold case like NOCASE does (ascii only) on both sides, so we
+            # agree with sqlite about which groups matched.
+            found_groups = {nocase(row[0]) for row in rows}
+
+        for group in named_groups:
+            if nocase(group) not in found_groups:
+                await message.channel.send("No snitches on namelayer "
+                    f"group `{group}` found in this database. If the "
+                    "group name is correct, omit it and re-run to "
+                    "avoid this error.")
+                await message.channel.send("Import aborted. You may "
+                    "safely re-run this import with different "
+                    "arguments.")
+                return
 
-            snitches_added = 0
-            if any(group == "all" for group in groups):
-                group_filter = "1"
-                # don't pass ["all"] if our filter doesn't have any params
-                groups_params = []
-            else:
-                # match case insensitive compare above.
-                group_filter = f"group_name COLLATE NOCASE IN ({('?, ' * len(groups))[:-2]})"
-                groups_params = groups
+        await message.channel.send("Importing snitches from snitchmod "
+            "database...")
 
-            rows = cur.execute("SELECT * FROM snitches_v2 WHERE "
-                f"{group_filter}", groups_params).fetchall()
+        if any(group == "all" for group in groups):
+            group_filter = "1"
+            # don't pass ["all"] if our filter doesn't have any params
+            groups_params = []
+        else:
+            # match case insensitive compare above.
+            group_filter = f"group_name COLLATE NOCASE IN ({('?, ' * len(groups))[:-2]})"
+            groups_params = groups
 
-            for row in rows:
-                snitch = Snitch.from_snitchmod(row)
-                # batch commit for speed
-                rowcount = db.add_snitch(message.guild.id, snitch, roles,
-                    commit=False)
-                snitches_added += rowcount
+        rows = cur.execute("SELECT * FROM snitches_v2 WHERE "
+            f"{group_filter}", groups_params).fetchall()
 
-            db.commit()
+        snitches = [Snitch.from_snitchmod(row) for row in rows]
+        snitches_added = await db.add_snitches(message.guild.id, snitches,
+            roles)
+        self.invalidate_snitches(message.guild.id)
 
         await message.channel.send(f"Added {snitches_added} new snitches.")
 
@@ -1093,21 +1712,19 @@ class Snitchvis(Client):
             "events from."
     )
     async def permissions(self, message):
-        # tells the command author what snitch channels they can view.
-        snitch_channels = db.get_snitch_channels(message.guild.id)
+        # tells the command author what snitch channels they can view. This is
+        # the same (cached) lookup get_events uses for permissions.
+        role_ids = frozenset(role.id for role in message.author.roles)
+        channel_ids = db.accessible_channels(message.guild.id, role_ids)
 
-        channels = set()
-        for role in message.author.roles:
-            for channel in snitch_channels:
-                if role.id in channel.allowed_roles:
-                    channels.add(channel)
-
-        if not channels:
+        if not channel_ids:
             await message.channel.send("You can't render any events.")
             return
 
+        mentions = ", ".join(f"<#{channel_id}>"
+            for channel_id in sorted(channel_ids))
         await message.channel.send("You can render events from the "
-            f"following channels: {utils.channel_str(channels)}")
+            f"following channels: {mentions}")
 
     @command("events", help="Lists the most recent events for the specified "
         "snitch or snitches.",
@@ -1132,11 +1749,7 @@ class Snitchvis(Client):
             return
 
         if name is not None:
-            events = db.select("""
-                SELECT * FROM event
-                WHERE guild_id = ? AND snitch_name = ?
-                ORDER BY t DESC LIMIT 10
-            """, [message.guild.id, name])
+            events = db.recent_events_by_name(message.guild.id, name)
         elif location:
             if len(location) == 2:
                 x, z = location
@@ -1149,37 +1762,20 @@ class Snitchvis(Client):
                     "`--location x y z` or `--location x z`")
                 return
 
-            try:
-                x = int(x)
-            except ValueError:
-                await message.channel.send(f"Invalid x coordinate `{x}`")
-                return
-
-            try:
-                y = int(y) if y else None
-            except ValueError:
-                await message.channel.send(f"Invalid y cooridnate `{y}`")
-                return
-
-            try:
-                z = int(z)
-            except ValueError:
-                await message.channel.send(f"Invalid z coordinate `{z}`")
-                return
+            coords = {"x": x, "y": y, "z": z}
+            for (axis, val) in coords.items():
+                if val is None:
+                    continue
+                try:
+                    coords[axis] = int(val)
+                except ValueError:
+                    await message.channel.send(f"Invalid {axis} coordinate "
+                        f"`{val}`")
+                    return
+            x, y, z = coords["x"], coords["y"], coords["z"]
 
             # swap y and z because that's what the db expects
-            if y is not None:
-                events = db.select("""
-                    SELECT * FROM event
-                    WHERE guild_id = ? AND x = ? AND y = ? AND z = ?
-                    ORDER BY t DESC LIMIT 10
-                """, [message.guild.id, x, z, y])
-            else:
-                events = db.select("""
-                    SELECT * FROM event
-                    WHERE guild_id = ? AND x = ? AND y = ?
-                    ORDER BY t DESC LIMIT 10
-                """, [message.guild.id, x, z])
+            events = db.recent_events_at(message.guild.id, x, z, y)
 
         if not events:
             await message.channel.send("No events match those criteria.")
@@ -1216,13 +1812,11 @@ class Snitchvis(Client):
             prefix = self.default_prefix if command.use_prefix else ""
             values_by_command[command.function] = (f"{prefix}{command.name}", command.help_short)
 
-        # sort by order in self.help_order, and send to end if not present
+        # sort by order in HELP_ORDER, and send to end if not present
         # (we don't care about ordering if we didn't specify it, as long as it's
         # kicked to the end)
         def _key(command):
-            if command in self.help_order:
-                return self.help_order.index(command)
-            return 999
+            return self.HELP_ORDER_INDEX.get(command.__name__, 999)
 
         values = [
             values_by_command[command]
@@ -1274,6 +1868,7 @@ class Snitchvis(Client):
             return
 
         db.set_livemap_channel(guild.id, channel.id)
+        self.livemap_channels.pop(guild.id, None)
         await message.channel.send(f"Set livemap channel to {channel.mention}.")
 
         lm_channel = db.get_livemap_channel_from_channel(channel.id)
@@ -1376,10 +1971,10 @@ class Snitchvis(Client):
                 "with `.create-command`.")
             return
 
-        text = "Current custom commands:\n"
-        for command in commands:
-            text += f"\n`.{command.command}` - runs `{command.command_text}`"
-        await message.channel.send(text)
+        lines = [f"`.{command.command}` - runs `{command.command_text}`"
+            for command in commands]
+        await message.channel.send("Current custom commands:\n\n" +
+            "\n".join(lines))
 
     @command("add-kira-config",
         help_short="Adds a kira config to the list of known formats.",
@@ -1397,9 +1992,7 @@ class Snitchvis(Client):
             if m.author.id != config.KIRA_ID:
                 continue
 
-            result = re.search("Relay config \*\*.*?\*\* is owned by .*?",
-                m.content)
-            if not result:
+            if not KIRA_CONFIG_NAME.search(m.content):
                 continue
 
             config_message = m
@@ -1414,23 +2007,17 @@ class Snitchvis(Client):
             return
 
         def search(pattern):
-            result = re.search(pattern, config_message.content)
+            result = pattern.search(config_message.content)
             if not result:
                 return None
             return result.group(1)
 
-        name = search("Relay config \*\*(.*)\*\* is owned by")
-        snitch_f = search("Format used for snitch alerts \(snitchformat\): "
-            "`` (.*) ``")
-        enter_f = search("Format used for entering a snitch range "
-            "\(snitchentermessage\): `` (.*) ``")
-        login_f = search("logins within a snitch range \(snitchloginmessage\): "
-            "`` (.*) ``")
-        # yes, kira has a typo (should be snitchlogoutmessage)
-        logout_f = search("Format used for logouts within a snitch range "
-            "\(snitchloginmessage\): `` (.*) ``")
-        time_f = search("Time format used for the time stamps of messages "
-            "\(timeformat\): `` (.*) ``")
+        name = search(KIRA_CONFIG_NAME)
+        snitch_f = search(KIRA_CONFIG_SNITCH)
+        enter_f = search(KIRA_CONFIG_ENTER)
+        login_f = search(KIRA_CONFIG_LOGIN)
+        logout_f = search(KIRA_CONFIG_LOGOUT)
+        time_f = search(KIRA_CONFIG_TIME)
 
         if any(v is None for v in [name, snitch_f, enter_f, login_f, time_f]):
             await message.channel.send("Could not find all the required "
@@ -1448,6 +2035,8 @@ class Snitchvis(Client):
             verbed = "added"
             db.add_kira_config(message.guild.id, name, snitch_f, enter_f,
                 login_f, logout_f, time_f)
+        self.kira_configs.pop(message.guild.id, None)
+        self.kira_prefixes.pop(message.guild.id, None)
 
         await message.channel.send(f"Succesfully {verbed} config for "
             f"`{name}`:\n\n"
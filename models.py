@@ -1,11 +1,16 @@
 from dataclasses import dataclass
 from datetime import datetime, timezone
+from functools import cached_property
+import re
 
 from discord import User, Guild
 from discord.abc import Messageable
 
 from utils import embed_grey, fire_later, create_embed
 
+# matches kira format placeholders, like %PLAYER% or %X%
+KIRA_PLACEHOLDER = re.compile(r"%[A-Z]+%")
+
 @dataclass
 class SnitchChannel:
     guild_id: int
@@ -117,6 +122,24 @@ class KiraConfig:
     snitch_logout_message: str
     time_format: str
 
+    # both of these are computed once per config, instead of once per message
+    # we try to parse with the config.
+
+    @cached_property
+    def prefix(self):
+        # the literal text our snitch format starts with, before its first
+        # placeholder. Any message which doesn't start with this text can't
+        # possibly match the format, which is much cheaper to check than
+        # letting Event.parse fail.
+        return KIRA_PLACEHOLDER.split(self.snitch_format, maxsplit=1)[0].strip()
+
+    @cached_property
+    def formats(self):
+        # the format arguments to Event.parse, in order
+        return (self.snitch_format, self.snitch_enter_message,
+            self.snitch_login_message, self.snitch_logout_message,
+            self.time_format)
+
 # used when we want to fake a discord message with our own
 # user/channel/guild/content.
 @dataclass
@@ -3,7 +3,7 @@ from datetime import timezone
 import asyncio
 import itertools
 
-from discord import Color, Embed
+from discord import Color, Embed, NotFound
 
 queue = asyncio.Queue()
 
@@ -15,6 +15,13 @@ def fire_later(awaitable):
     queue.put_nowait((future, awaitable))
     return future
 
+async def delete_message(message):
+    # deletes `message`, unless someone beat us to it
+    try:
+        await message.delete()
+    except NotFound:
+        pass
+
 embed_grey = Color.from_rgb(156, 156, 156)
 
 def channel_str(channels):